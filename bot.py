@@ -1,10 +1,15 @@
 import os
 import io
+import re
 import json
-import math
 import gzip
+import hashlib
+import sqlite3
+import threading
 import asyncio
 import logging
+from collections import OrderedDict, deque
+from operator import attrgetter
 from datetime import datetime, timezone, timedelta
 from typing import Dict, List, Optional, Any, Iterable
 
@@ -12,6 +17,11 @@ import discord
 from discord.ext import commands, tasks
 from discord import app_commands
 
+try:
+    import orjson
+except ImportError:  # orjson が無い環境では標準 json で代替
+    orjson = None
+
 # ========= 環境変数 =========
 DISCORD_TOKEN = os.getenv("DISCORD_TOKEN")  # 必須
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
@@ -38,7 +48,8 @@ log = logging.getLogger("vc_text_archiver")
 # ========= 永続 =========
 DATA_DIR = "data_vc_text"
 os.makedirs(DATA_DIR, exist_ok=True)
-SETTINGS_FILE = os.path.join(DATA_DIR, "settings.json")
+SETTINGS_DB = os.path.join(DATA_DIR, "settings.db")
+SETTINGS_FILE = os.path.join(DATA_DIR, "settings.json")  # 旧形式（起動時に SETTINGS_DB へ移行）
 
 # ========= Intents / Bot =========
 intents = discord.Intents.default()
@@ -48,14 +59,29 @@ intents.members = True           # メンバー一覧バックアップのため
 intents.messages = True
 intents.reactions = True
 
-bot = commands.Bot(command_prefix="!", intents=intents)
+class ArchiverBot(commands.Bot):
+    async def setup_hook(self):
+        # on_ready は再接続のたびに呼ばれるので、ディスクからの読み込み・移行は起動時に1回だけ行う
+        # （保存待ち・書き込み中の設定を古い DB の内容で上書きしないように）
+        load_settings()
+        migrate_legacy_channel_files()
+
+    async def close(self):
+        # 未書き込みのVCテキスト・設定を落とさないよう、終了前に書き出す
+        await flush_pending_lines()
+        async with _flush_lock:
+            close_all_channel_fds()
+        flush_settings_now()
+        await super().close()
+
+bot = ArchiverBot(command_prefix="!", intents=intents)
 tree = bot.tree
 
 # ========= タイムゾーン（JST） =========
 JST = timezone(timedelta(hours=9))
 
 # ========= 設定・状態 =========
-# guild_settings = {
+# guild_settings = {  （SETTINGS_DB の読み取り用ミラー）
 #   guild_id: {
 #       "log_channel_id": int|None,
 #       "max_messages_per_channel": int,
@@ -63,8 +89,24 @@ JST = timezone(timedelta(hours=9))
 #   }
 # }
 guild_settings: Dict[int, Dict] = {}
-# { channel_id: [ {ts, author_id, author_name, content, attachments, edited, deleted, message_id}, ... ] }
-vc_text_buffer: Dict[int, List[Dict]] = {}
+# { guild_id: frozenset(category_whitelist) }  メッセージ毎の判定用キャッシュ（設定変更時に破棄）
+_wl_cache: Dict[int, frozenset] = {}
+# { channel_id: deque([ {ts, author_id, author_name, content, attachments, edited, deleted, message_id}, ... ]) }
+# maxlen = max_messages_per_channel（古いものから自動で捨てる）
+vc_text_buffer: Dict[int, deque] = {}
+# { channel_id: guild_id }  切り詰め件数（ギルド設定）を引くため / set_max で該当チャンネルの deque を作り直すため
+_channel_guild: Dict[int, int] = {}
+# { channel_id: [JSONL行(bytes), ...] }  ディスク未書き込みの行（vc_text_writer がまとめて追記）
+_pending_lines: Dict[int, List[bytes]] = {}
+_flush_lock = asyncio.Lock()
+# { channel_id: {record_key(64bit int), ...} }  記録済みレコードのキー（書き込み時点で重複を弾く）
+_dedup_index: Dict[int, set] = {}
+# { channel_id: JSONLの行数 }  上限を ROTATE_SLACK 件超えたら末尾 max_messages_per_channel 件に切り詰める
+_disk_count: Dict[int, int] = {}
+ROTATE_SLACK = 500
+# { channel_id: fd }  追記用に開いたままのファイル（LRUで MAX_OPEN_FDS 個まで。_flush_lock 保持中のみ触る）
+_channel_fds: "OrderedDict[int, int]" = OrderedDict()
+MAX_OPEN_FDS = 512
 
 DEFAULT_SETTINGS = {
     "log_channel_id": None,
@@ -73,14 +115,34 @@ DEFAULT_SETTINGS = {
 }
 
 # ========= 共通ユーティリティ =========
+_ID_RE = re.compile(r"\d+")
+
 def parse_id_list(text: Optional[str]) -> List[int]:
-    if not text:
-        return []
-    out: List[int] = []
-    for part in text.replace(" ", "").split(","):
-        if part.isdigit():
-            out.append(int(part))
-    return out
+    """数字列をすべて拾い、出現順を保ったまま重複を除く"""
+    return list(dict.fromkeys(int(m) for m in _ID_RE.findall(text or "")))
+
+def _orjson_default(obj: Any) -> Any:
+    """orjson が扱えない型を標準 json と同じ形にする（discord.Locale 等の tuple 派生は配列、それ以外は文字列）"""
+    if isinstance(obj, tuple):
+        return list(obj)
+    return str(obj)
+
+def json_bytes(obj: Any, *, indent: bool = False) -> bytes:
+    """UTF-8 の JSON bytes にする（int キーは文字列化）"""
+    if orjson is not None:
+        return orjson.dumps(obj, default=_orjson_default,
+                            option=orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if indent else 0))
+    return json.dumps(obj, ensure_ascii=False, indent=2 if indent else None).encode("utf-8")
+
+def json_line(obj: Any) -> bytes:
+    """JSONL の1行（UTF-8・末尾改行つき）にする"""
+    if orjson is not None:
+        return orjson.dumps(obj, default=_orjson_default,
+                            option=orjson.OPT_NON_STR_KEYS | orjson.OPT_APPEND_NEWLINE)
+    return json.dumps(obj, ensure_ascii=False).encode("utf-8") + b"\n"
+
+def json_loads(data: bytes) -> Any:
+    return orjson.loads(data) if orjson is not None else json.loads(data)
 
 def ensure_dir(path: str):
     os.makedirs(path, exist_ok=True)
@@ -88,137 +150,464 @@ def ensure_dir(path: str):
 def jst_now_iso() -> str:
     return datetime.now(JST).isoformat()
 
+# 429 と 500/502/504 は discord.py の HTTPClient が既に再試行するので、ここでは 503 だけを扱う
+# （メッセージ送信は冪等ではないため、処理済みの可能性がある 5xx を重ねて再試行しない）
+RETRY_STATUSES = (503,)
+
+async def with_retry(coro_factory, *, max_retries: int = 3, base: float = 0.5):
+    """discord.py が再試行しない一時的なHTTPエラー（503）を指数バックオフで再試行する。coro_factory は毎回新しいコルーチンを返すこと"""
+    for attempt in range(max_retries):
+        try:
+            return await coro_factory()
+        except discord.HTTPException as e:
+            if e.status not in RETRY_STATUSES or attempt == max_retries - 1:
+                raise
+            delay = base * 2 ** attempt
+            log.warning("HTTP %s のため %.1f 秒後に再試行 (%d/%d)", e.status, delay, attempt + 1, max_retries)
+            await asyncio.sleep(delay)
+
+async def gather_or_cancel(*coros) -> List[Any]:
+    """asyncio.gather と同じく結果を順に返す。どれかが失敗（または呼び出し元がキャンセル）したら
+    残りのタスクをキャンセルし、終わるのを待ってから例外を送出する（裏で走り続けるタスクを残さない）"""
+    tasks = [asyncio.ensure_future(c) for c in coros]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
 # ========= 既存：VCテキスト保存関連 =========
 def channel_file_path(channel_id: int) -> str:
+    return os.path.join(DATA_DIR, f"{channel_id}.jsonl")
+
+def legacy_channel_file_path(channel_id: int) -> str:
+    """旧形式（JSON配列）のファイルパス"""
     return os.path.join(DATA_DIR, f"{channel_id}.json")
 
+def migrate_legacy_channel_files():
+    """旧形式 {channel_id}.json（JSON配列）を {channel_id}.jsonl（1行1レコード）に変換する"""
+    settings_name = os.path.basename(SETTINGS_FILE)
+    for fn in os.listdir(DATA_DIR):
+        if not fn.endswith(".json") or fn == settings_name:
+            continue
+        stem = fn[:-len(".json")]
+        if not stem.isdigit():
+            continue
+        src = os.path.join(DATA_DIR, fn)
+        try:
+            with open(src, "rb") as f:
+                records = dedup(json_loads(f.read()))
+            lines = [json_line(r) for r in records]
+            dst = channel_file_path(int(stem))
+            # 既に .jsonl がある場合は旧データを先頭に置く
+            try:
+                with open(dst, "rb") as f:
+                    existing = f.read()
+            except FileNotFoundError:
+                existing = b""
+            with open(dst, "wb") as f:
+                f.write(b"".join(lines) + existing)
+            os.remove(src)
+            log.info("VCテキストをJSONLへ移行: %s (%d 件)", fn, len(lines))
+        except Exception as e:
+            log.exception("VCテキストのJSONL移行失敗: %s: %s", fn, e)
+
+def _open_settings_db() -> sqlite3.Connection:
+    conn = sqlite3.connect(SETTINGS_DB, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(
+        """
+        CREATE TABLE IF NOT EXISTS guild_settings(
+            guild_id INTEGER PRIMARY KEY,
+            log_channel_id INTEGER,
+            max_messages INTEGER
+        );
+        CREATE TABLE IF NOT EXISTS category_whitelist(
+            guild_id INTEGER,
+            category_id INTEGER,
+            PRIMARY KEY(guild_id, category_id)
+        );
+        """
+    )
+    return conn
+
+settings_db = _open_settings_db()
+# executor からの書き込みと終了時の同期書き込みが重ならないようにする
+_settings_db_lock = threading.Lock()
+
+def _new_conf(log_channel_id: Optional[int] = None, max_messages: Optional[int] = None) -> Dict:
+    return {
+        "log_channel_id": log_channel_id,
+        "max_messages_per_channel": max_messages if max_messages is not None else DEFAULT_SETTINGS["max_messages_per_channel"],
+        "category_whitelist": [],
+    }
+
+def write_settings(confs: Dict[int, Dict]) -> bool:
+    """指定ギルドの行だけを1トランザクションで書き換える。コミットできたら True"""
+    try:
+        with _settings_db_lock, settings_db:
+            for gid, conf in confs.items():
+                settings_db.execute(
+                    "INSERT OR REPLACE INTO guild_settings(guild_id, log_channel_id, max_messages) VALUES (?, ?, ?)",
+                    (gid, conf.get("log_channel_id"), conf.get("max_messages_per_channel")),
+                )
+                settings_db.execute("DELETE FROM category_whitelist WHERE guild_id = ?", (gid,))
+                settings_db.executemany(
+                    "INSERT OR IGNORE INTO category_whitelist(guild_id, category_id) VALUES (?, ?)",
+                    [(gid, cid) for cid in conf.get("category_whitelist") or []],
+                )
+    except Exception as e:
+        log.exception("設定の保存失敗: %s", e)
+        return False
+    return True
+
+def _migrate_settings_json():
+    """旧 settings.json を SETTINGS_DB に取り込み、.bak にリネームする"""
+    try:
+        with open(SETTINGS_FILE, "rb") as f:
+            raw = f.read()
+        data = json_loads(raw)
+        if not write_settings({int(k): v for k, v in data.items()}):
+            # 取り込めなかった場合は settings.json を残し、次回起動時に再度移行する
+            log.error("設定の移行を中止しました（%s はそのまま残します）", SETTINGS_FILE)
+            return
+        os.replace(SETTINGS_FILE, SETTINGS_FILE + ".bak")
+        log.info("設定を %s から %s へ移行しました", SETTINGS_FILE, SETTINGS_DB)
+    except Exception as e:
+        log.exception("設定ファイルの移行失敗: %s", e)
+
 def load_settings():
+    """SETTINGS_DB を読み込み、メモリ上の guild_settings（読み取り用ミラー）を作り直す"""
     global guild_settings
+    # 保存待ちの変更があれば先に書き出し、読み直しで失われないようにする
+    flush_settings_now()
+    _wl_cache.clear()
     if os.path.exists(SETTINGS_FILE):
-        try:
-            with open(SETTINGS_FILE, "r", encoding="utf-8") as f:
-                data = json.load(f)
-            guild_settings = {int(k): v for k, v in data.items()}
-        except Exception as e:
-            log.exception("設定ファイル読み込み失敗: %s", e)
-            guild_settings = {}
-    else:
+        _migrate_settings_json()
+    try:
+        settings: Dict[int, Dict] = {}
+        # 接続は executor の書き込みと共有しているので、書きかけの行を読まないようロックを取る
+        with _settings_db_lock:
+            rows = settings_db.execute(
+                "SELECT guild_id, log_channel_id, max_messages FROM guild_settings"
+            ).fetchall()
+            wl_rows = settings_db.execute(
+                "SELECT guild_id, category_id FROM category_whitelist ORDER BY rowid"
+            ).fetchall()
+        for gid, log_ch, max_msg in rows:
+            settings[gid] = _new_conf(log_ch, max_msg)
+        for gid, cid in wl_rows:
+            settings.setdefault(gid, _new_conf())["category_whitelist"].append(cid)
+        guild_settings = settings
+    except Exception as e:
+        log.exception("設定の読み込み失敗: %s", e)
         guild_settings = {}
 
-def save_settings():
+_settings_save_handle: Optional[asyncio.TimerHandle] = None
+_dirty_guilds: set = set()
+SETTINGS_SAVE_DELAY = 0.5
+
+def save_settings(guild_id: int):
+    """変更のあったギルドを記録し、SETTINGS_SAVE_DELAY 秒後にまとめて1回だけ書き出す"""
+    global _settings_save_handle
+    _dirty_guilds.add(guild_id)
     try:
-        with open(SETTINGS_FILE, "w", encoding="utf-8") as f:
-            json.dump(guild_settings, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        log.exception("設定ファイル保存失敗: %s", e)
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        flush_settings_now()
+        return
+    if _settings_save_handle is None:
+        _settings_save_handle = loop.call_later(SETTINGS_SAVE_DELAY, _start_settings_flush)
+
+def _take_dirty_settings() -> Dict[int, Dict]:
+    """変更のあったギルド設定のコピーを取り出す（executor 側で書く間に変更されても崩れないように）"""
+    confs = {}
+    for gid in _dirty_guilds:
+        conf = guild_settings.get(gid)
+        if conf is not None:
+            confs[gid] = dict(conf, category_whitelist=list(conf.get("category_whitelist") or []))
+    _dirty_guilds.clear()
+    return confs
+
+def _start_settings_flush():
+    global _settings_save_handle
+    _settings_save_handle = None
+    asyncio.get_running_loop().create_task(flush_settings())
+
+async def flush_settings():
+    """保留中の設定を executor で書き出す（イベントループを塞がない）"""
+    confs = _take_dirty_settings()
+    if confs:
+        await asyncio.get_running_loop().run_in_executor(None, write_settings, confs)
+
+def flush_settings_now():
+    """保留中の設定保存があれば即座に（同期で）書き出す。終了時・ループ外用"""
+    global _settings_save_handle
+    if _settings_save_handle is not None:
+        _settings_save_handle.cancel()
+        _settings_save_handle = None
+    confs = _take_dirty_settings()
+    if confs:
+        write_settings(confs)
 
 def guild_conf(guild_id: int) -> Dict:
     conf = guild_settings.get(guild_id)
     if not conf:
-        conf = DEFAULT_SETTINGS.copy()
+        # 既定値のままなら保存しない（設定コマンドで変更された時点で保存される）
+        conf = _new_conf()
         guild_settings[guild_id] = conf
-        save_settings()
+        return conf
     for k, v in DEFAULT_SETTINGS.items():
         conf.setdefault(k, v)
     if not isinstance(conf.get("category_whitelist"), list):
         conf["category_whitelist"] = []
     return conf
 
-def append_message_to_disk(channel_id: int, record: Dict):
-    path = channel_file_path(channel_id)
-    data = []
-    if os.path.exists(path):
+def buffer_record(guild_id: int, channel_id: int, record: Dict):
+    """メモリに追加し、JSONL行を書き込み待ちに積む（ディスクI/Oはしない）。記録済みなら何もしない"""
+    keys = _dedup_index.get(channel_id)
+    if keys is None:
+        # 再起動後の初回のみ、既存の JSONL からキーと行数を復元する
+        disk = read_channel_file(channel_id)
+        keys = _dedup_index[channel_id] = {record_key(r) for r in disk}
+        _disk_count[channel_id] = len(disk)
+    key = record_key(record)
+    if key in keys:
+        return
+    keys.add(key)
+    buf = vc_text_buffer.get(channel_id)
+    if buf is None:
+        buf = vc_text_buffer[channel_id] = deque(maxlen=int(guild_conf(guild_id)["max_messages_per_channel"]))
+        _channel_guild[channel_id] = guild_id
+    buf.append(record)
+    _pending_lines.setdefault(channel_id, []).append(json_line(record))
+
+def _truncate_to_tail(path: str, keep: int):
+    """末尾 keep 行だけを残してファイルを置き換える"""
+    with open(path, "rb") as f:
+        tail = deque(f, maxlen=keep)
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.writelines(tail)
+    os.replace(tmp, path)
+
+def _channel_fd(channel_id: int) -> int:
+    fd = _channel_fds.get(channel_id)
+    if fd is not None:
+        _channel_fds.move_to_end(channel_id)
+        return fd
+    fd = os.open(channel_file_path(channel_id), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    _channel_fds[channel_id] = fd
+    if len(_channel_fds) > MAX_OPEN_FDS:
+        _, old = _channel_fds.popitem(last=False)
+        os.close(old)
+    return fd
+
+def close_channel_fd(channel_id: int):
+    fd = _channel_fds.pop(channel_id, None)
+    if fd is not None:
         try:
-            with open(path, "r", encoding="utf-8") as f:
-                data = json.load(f)
-        except Exception:
-            data = []
-    data.append(record)
+            os.close(fd)
+        except OSError:
+            pass
+
+def close_all_channel_fds():
+    for channel_id in list(_channel_fds):
+        close_channel_fd(channel_id)
+
+_IOV_MAX = 1024
+
+def _write_lines(fd: int, lines: List[bytes]):
+    """複数行を writev でまとめて書く（writev が無い環境では join して write）"""
+    if not hasattr(os, "writev"):
+        batches = [[b"".join(lines)]]
+    else:
+        batches = [lines[i:i + _IOV_MAX] for i in range(0, len(lines), _IOV_MAX)]
+    for batch in batches:
+        written = os.writev(fd, batch) if len(batch) > 1 else os.write(fd, batch[0])
+        total = sum(len(b) for b in batch)
+        if written < total:
+            # 部分書き込み時は残りを書き切る
+            rest = memoryview(b"".join(batch))[written:]
+            while rest:
+                rest = rest[os.write(fd, rest):]
+
+def _append_lines_to_disk(jobs: List[tuple]):
+    """チャンネルごとにまとめて追記し、必要なら切り詰める（executor 上で実行）"""
+    for channel_id, lines, keep in jobs:
+        try:
+            _write_lines(_channel_fd(channel_id), lines)
+            if keep is not None:
+                # 置き換え後は別ファイルになるので、開いている fd は閉じておく
+                close_channel_fd(channel_id)
+                _truncate_to_tail(channel_file_path(channel_id), keep)
+        except Exception as e:
+            log.exception("VCテキストの書き込み失敗: %s", e)
+
+async def flush_pending_lines():
+    """書き込み待ちの行をディスクへ。イベントループを塞がないよう executor で書く"""
+    async with _flush_lock:
+        if not _pending_lines:
+            return
+        jobs = []
+        for channel_id, lines in _pending_lines.items():
+            count = _disk_count.get(channel_id, 0) + len(lines)
+            buf = vc_text_buffer.get(channel_id)
+            gid = _channel_guild.get(channel_id)
+            # 上限は現在のギルド設定から取る（set_max で変わっても再起動を待たない）
+            limit = int(guild_conf(gid)["max_messages_per_channel"]) if gid is not None else None
+            keep = None
+            if buf is not None and limit and count > limit + ROTATE_SLACK:
+                keep = count = limit
+                # 切り詰めで消える分のキーも捨てる（キー集合の肥大化防止）
+                _dedup_index[channel_id] = {record_key(r) for r in buf}
+            _disk_count[channel_id] = count
+            jobs.append((channel_id, lines, keep))
+        _pending_lines.clear()
+        await asyncio.get_running_loop().run_in_executor(None, _append_lines_to_disk, jobs)
+
+@tasks.loop(seconds=0.2)
+async def vc_text_writer():
+    await flush_pending_lines()
+
+def read_channel_file(channel_id: int, keep: Optional[int] = None) -> List[Dict]:
+    """JSONL を1行ずつ読み込む（壊れた行は読み飛ばす）。keep 指定時は末尾 keep 行だけを解析する"""
+    path = channel_file_path(channel_id)
+    out: List[Dict] = []
     try:
-        with open(path, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False)
-    except Exception as e:
-        log.exception("VCテキストの書き込み失敗: %s", e)
+        with open(path, "rb") as f:
+            lines = deque(f, maxlen=keep) if keep else f
+            for line in lines:
+                if not line.strip():
+                    continue
+                try:
+                    out.append(json_loads(line))
+                except ValueError:
+                    log.warning("壊れた行をスキップ: %s", path)
+    except FileNotFoundError:
+        return out
+    except Exception:
+        return []
+    return out
+
+def record_key(r: Dict) -> int:
+    """message_id / ts / edited / deleted の64bitハッシュを重複判定キーにする。
+    本文は含めない（同じ message_id・ts・フラグなら同一イベント。長い本文のハッシュ計算を省く）"""
+    h = hashlib.blake2b(digest_size=8)
+    h.update(str(r.get("message_id")).encode())
+    h.update(b"|")
+    h.update((r.get("ts") or "").encode())
+    h.update(b"|1" if r.get("edited") else b"|0")
+    h.update(b"|1" if r.get("deleted") else b"|0")
+    return int.from_bytes(h.digest(), "little")
 
 def dedup(records: List[Dict]) -> List[Dict]:
-    """message_id / ts / content / edited / deleted をキーに重複排除"""
-    seen = set()
-    out = []
+    """record_key で重複排除し、同じキーは後勝ち（旧形式ファイルの移行用。新規分は buffer_record で弾いている）"""
+    seen: Dict[int, Dict] = {}
     for r in records:
-        key = (
-            r.get("message_id"),
-            r.get("ts"),
-            r.get("content"),
-            bool(r.get("edited")),
-            bool(r.get("deleted")),
-        )
-        if key in seen:
-            continue
-        seen.add(key)
-        out.append(r)
-    return out
+        seen[record_key(r)] = r
+    return list(seen.values())
+
+def load_channel_records(channel_id: int, keep: Optional[int] = None) -> List[Dict]:
+    """ディスク（JSONL）を正として末尾 keep 件を返す。読めない場合のみメモリ上の記録を使う。
+    メモリ上の記録はすべてディスクにも書かれており、重複は書き込み時に除去済み"""
+    mem = vc_text_buffer.get(channel_id, ())
+    if mem and len(mem) == _disk_count.get(channel_id):
+        # ディスクの行がすべてメモリにもある（再起動後に書かれた分だけ等）ならファイルを読まない
+        disk = []
+    else:
+        disk = read_channel_file(channel_id, keep)
+    records = disk or list(mem)
+    return records[-keep:] if keep else records
 
-def load_channel_records(channel_id: int) -> List[Dict]:
-    """ディスク+メモリをマージし、重複除去して返す"""
-    mem = vc_text_buffer.get(channel_id, [])
-    disk = []
-    path = channel_file_path(channel_id)
-    if os.path.exists(path):
-        try:
-            with open(path, "r", encoding="utf-8") as f:
-                disk = json.load(f)
-        except Exception:
-            disk = []
-    return dedup(disk + mem)
+def _unlink_quiet(path: str):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
 
 def remove_channel_disk(channel_id: int):
-    path = channel_file_path(channel_id)
-    if os.path.exists(path):
-        try:
-            os.remove(path)
-        except Exception:
-            pass
+    for path in (channel_file_path(channel_id), legacy_channel_file_path(channel_id)):
+        _unlink_quiet(path)
+
+_VOICE_TYPES = frozenset((discord.ChannelType.voice, discord.ChannelType.stage_voice))
+
+async def purge_channel_files():
+    """DATA_DIR 内のチャンネル別ファイル（.json / .jsonl）を executor で並列に削除する"""
+    settings_name = os.path.basename(SETTINGS_FILE)
+    with os.scandir(DATA_DIR) as it:
+        paths = [e.path for e in it if e.name.endswith((".json", ".jsonl")) and e.name != settings_name]
+    loop = asyncio.get_running_loop()
+    await asyncio.gather(*(loop.run_in_executor(None, _unlink_quiet, p) for p in paths))
 
 def is_voice_like(ch: discord.abc.GuildChannel) -> bool:
-    return getattr(ch, "type", None) in (discord.ChannelType.voice, discord.ChannelType.stage_voice)
+    return getattr(ch, "type", None) in _VOICE_TYPES
 
 def is_voice_message(message: discord.Message) -> bool:
-    return getattr(message.channel, "type", None) in (discord.ChannelType.voice, discord.ChannelType.stage_voice)
+    # 全メッセージで呼ばれるので DM を先に弾き、type を直接見る
+    return message.guild is not None and message.channel.type in _VOICE_TYPES
 
 def in_target_categories(guild_id: int, channel: discord.abc.GuildChannel) -> bool:
     """カテゴリー制限（ホワイトリスト）。空なら全許可。"""
-    conf = guild_conf(guild_id)
-    wl = conf.get("category_whitelist") or []
-    if not wl:
-        return True
-    parent = getattr(channel, "category", None)
-    if parent is None:
-        return False
-    return parent.id in wl
+    wl = _wl_cache.get(guild_id)
+    if wl is None:
+        wl = _wl_cache[guild_id] = frozenset(guild_conf(guild_id)["category_whitelist"])
+    return not wl or getattr(channel, "category_id", None) in wl
 
-def fmt_record(rec: Dict) -> str:
-    t = rec.get("ts")
+TS_DISPLAY_FMT = "%Y-%m-%d %H:%M:%S"
+
+def display_ts(t: Optional[str]) -> Optional[str]:
+    """ISO形式の ts をログ表示用に整形（ts_display を持たない旧レコード用）"""
     try:
-        ts = datetime.fromisoformat(t).astimezone()
-        ts_s = ts.strftime("%Y-%m-%d %H:%M:%S")
+        return datetime.fromisoformat(t).astimezone().strftime(TS_DISPLAY_FMT)
     except Exception:
-        ts_s = t
-    flags = []
-    if rec.get("edited"):
-        flags.append("(edited)")
-    if rec.get("deleted"):
-        flags.append("(deleted)")
-    flag_s = " ".join(flags) if flags else ""
-    base = f"[{ts_s}] {rec.get('author_name')}({rec.get('author_id')}): {rec.get('content')}"
+        return t
+
+def fmt_record(rec: Dict) -> str:
+    ts_s = rec.get("ts_display") or display_ts(rec.get("ts"))
+    parts = [f"[{ts_s}] {rec.get('author_name')}({rec.get('author_id')}): {rec.get('content')}"]
     atts = rec.get("attachments") or []
     if atts:
-        base += "\n  attachments:\n" + "\n".join([f"  - {u}" for u in atts])
-    if flag_s:
-        base += f"  {flag_s}"
-    return base
-
-def build_txt(parts: List[Dict]) -> str:
-    return "\n".join(fmt_record(r) for r in parts)
+        parts.append("\n  attachments:")
+        parts.extend(f"\n  - {u}" for u in atts)
+    if rec.get("edited"):
+        parts.append("  (edited)")
+        if rec.get("deleted"):
+            parts.append(" (deleted)")
+    elif rec.get("deleted"):
+        parts.append("  (deleted)")
+    return "".join(parts)
+
+def build_gz_chunks(records: List[Dict], limit: int) -> List[bytes]:
+    """レコードを1行ずつ gzip に流し込み、圧縮後 limit バイト以下のパートに区切る。
+    各パートはレコード境界で閉じた独立の .gz なので単独で展開できる"""
+    chunks: List[bytes] = []
+    out = io.BytesIO()
+    gz = gzip.GzipFile(fileobj=out, mode="wb", compresslevel=6)
+    has_data = False
+    unflushed = 0  # 圧縮器内に留まっている可能性のある生バイト数（圧縮後サイズの上限見積もり用）
+    for r in records:
+        line = (fmt_record(r) + "\n").encode("utf-8")
+        if has_data and out.tell() + unflushed + len(line) > limit:
+            # 見積もりが上限を超えそうなときだけ flush して実サイズを確かめる
+            gz.flush()
+            unflushed = 0
+            if out.tell() + len(line) > limit:
+                gz.close()
+                chunks.append(out.getvalue())
+                out = io.BytesIO()
+                gz = gzip.GzipFile(fileobj=out, mode="wb", compresslevel=6)
+                has_data = False
+        gz.write(line)
+        unflushed += len(line)
+        has_data = True
+    if has_data:
+        gz.close()
+        chunks.append(out.getvalue())
+    return chunks
 
 async def send_chunked_logs(
     guild: discord.Guild,
@@ -238,12 +627,9 @@ async def send_chunked_logs(
             log.warning("指定のログチャンネルが見つかりません: %s", dest_channel_id)
             return
 
-    all_records = dedup(all_records)
-
-    text = build_txt(all_records)
-    raw = text.encode("utf-8", errors="ignore")
     MAX = 7_500_000  # Discord添付分割の安全閾値
-    chunks = max(1, math.ceil(len(raw) / MAX)) if raw else 1
+    # 整形・エンコード・圧縮は CPU 処理なので executor で行い、ゲートウェイを止めない
+    bufs = await asyncio.get_running_loop().run_in_executor(None, build_gz_chunks, all_records, MAX)
 
     header = (
         f"🔔 **VCテキストログ（チャンネル削除検知）**\n"
@@ -254,18 +640,27 @@ async def send_chunked_logs(
         f"- 総メッセージ: {len(all_records)} 件\n"
         f"- 生成: {datetime.now().astimezone().strftime('%Y-%m-%d %H:%M:%S')}\n"
     )
-    await dest.send(header)
-
-    if not raw:
-        await dest.send("（メッセージは記録されていませんでした）")
+    if not bufs:
+        await with_retry(lambda: dest.send(header + "（メッセージは記録されていませんでした）"))
         return
 
-    for i in range(chunks):
-        start = i * MAX
-        end = min((i + 1) * MAX, len(raw))
-        buf = io.BytesIO(raw[start:end])
-        buf.name = f"vc_text_{deleted_channel.id}_part{i+1}of{chunks}.txt"
-        await dest.send(file=discord.File(buf))
+    chunks = len(bufs)
+    sem = asyncio.Semaphore(3)
+
+    async def send_part(i: int, part: bytes, content: Optional[str] = None):
+        name = f"vc_text_{deleted_channel.id}_part{i}of{chunks}.txt.gz"
+        async with sem:
+            # discord.File は送信後に閉じられるため、再試行ごとに作り直す
+            # Messageable.send は content を str() するので MISSING ではなく None のまま渡す
+            await with_retry(lambda: dest.send(
+                content,
+                file=discord.File(io.BytesIO(part), filename=name),
+            ))
+
+    # ヘッダーは part1 の本文として先頭に送る（別メッセージにしない）
+    await send_part(1, bufs[0], header)
+    # 残りの到着順は前後しうるが、ファイル名の partXofY で順序が分かる
+    await asyncio.gather(*(send_part(i, part) for i, part in enumerate(bufs[1:], start=2)))
 
 # ========= バックアップ（スナップショット）機能 =========
 
@@ -301,6 +696,8 @@ def _ch_serialize(ch: discord.abc.GuildChannel) -> Dict[str, Any]:
         base["extra"] = {"default_thread_slowmode_delay": ch.default_thread_slowmode_delay}
     return base
 
+_by_position = attrgetter("position")
+
 async def dump_guild_structure(guild: discord.Guild) -> Dict[str, Any]:
     roles = [
         {
@@ -308,27 +705,37 @@ async def dump_guild_structure(guild: discord.Guild) -> Dict[str, Any]:
             "managed": r.managed, "mentionable": r.mentionable,
             "permissions": r.permissions.value, "position": r.position
         }
-        for r in sorted(guild.roles, key=lambda x: x.position, reverse=False)
+        for r in sorted(guild.roles, key=_by_position)
     ]
 
+    # guild.channels を1回だけ走査してカテゴリ・カテゴリ配下・未分類に振り分ける
+    cats: List[discord.CategoryChannel] = []
+    by_parent: Dict[int, List[discord.abc.GuildChannel]] = {}
+    uncat: List[discord.abc.GuildChannel] = []
+    for c in guild.channels:
+        if isinstance(c, discord.CategoryChannel):
+            cats.append(c)
+        elif c.category_id:
+            by_parent.setdefault(c.category_id, []).append(c)
+        else:
+            uncat.append(c)
+    # キャッシュに親カテゴリが無いものは未分類として扱う（ch.category is None と同じ）
+    for pid in by_parent.keys() - {c.id for c in cats}:
+        uncat.extend(by_parent.pop(pid))
+
     categories = []
-    for cat in sorted([c for c in guild.channels if isinstance(c, discord.CategoryChannel)], key=lambda x: x.position):
-        cat_data = {
+    for cat in sorted(cats, key=_by_position):
+        # CategoryChannel.channels と同じ並び（TextChannel が先、それ以外は後。その中で position）
+        children = sorted(by_parent.get(cat.id, ()), key=lambda x: (not isinstance(x, discord.TextChannel), x.position))
+        categories.append({
             "id": cat.id,
             "name": cat.name,
             "position": cat.position,
             "overwrites": _ow_serialize(cat.overwrites),
-            "children": []
-        }
-        for ch in sorted(cat.channels, key=lambda x: x.position):
-            cat_data["children"].append(_ch_serialize(ch))
-        categories.append(cat_data)
-
-    uncategorized = [
-        _ch_serialize(ch)
-        for ch in sorted(guild.channels, key=lambda x: getattr(x, "position", 0))
-        if ch.category is None and not isinstance(ch, discord.CategoryChannel)
-    ]
+            "children": [_ch_serialize(ch) for ch in children]
+        })
+
+    uncategorized = [_ch_serialize(ch) for ch in sorted(uncat, key=_by_position)]
 
     return {
         "meta": {
@@ -364,8 +771,9 @@ async def dump_members(guild: discord.Guild) -> List[Dict[str, Any]]:
         })
     return members
 
-def _serialize_message(msg: discord.Message) -> Dict[str, Any]:
-    return {
+def _serialize_message_line(msg: discord.Message) -> bytes:
+    """メッセージを JSONL の1行（bytes）にする"""
+    return json_line({
         "id": msg.id,
         "channel_id": msg.channel.id if msg.channel else None,
         "author_id": msg.author.id if msg.author else None,
@@ -391,70 +799,109 @@ def _serialize_message(msg: discord.Message) -> Dict[str, Any]:
             "guild_id": msg.reference.guild_id,
             "type": msg.reference.type.name if msg.reference.type else None
         } if msg.reference else None)
-    }
+    })
 
-async def append_jsonl(path: str, obj: Dict[str, Any]):
-    ensure_dir(os.path.dirname(path))
-    line = json.dumps(obj, ensure_ascii=False)
-    with gzip.open(path, "at", encoding="utf-8") as f:
-        f.write(line + "\n")
+def _write_gz_json(path: str, data: Any):
+    payload = gzip.compress(json_bytes(data, indent=True), compresslevel=6)
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(payload)
+    os.replace(tmp, path)
 
 async def write_json(path: str, data: Any):
+    """シリアライズ・圧縮・書き込みを1回ずつ、スレッドでまとめて行う（途中で落ちても壊れたファイルを残さない）"""
     ensure_dir(os.path.dirname(path))
-    with gzip.open(path, "wt", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    await asyncio.to_thread(_write_gz_json, path, data)
+
+# 同時に履歴を取得するチャンネル数（レート制限はチャンネル単位）
+MESSAGE_DUMP_CONCURRENCY = 3
 
 async def dump_messages_for_channels(guild: discord.Guild, since_utc: datetime, channel_ids: Iterable[int], base_dir: str) -> Dict[int, int]:
     """
     指定チャンネルIDのみ、since_utc 以降のメッセージを JSONL.GZ で書き出す。
+    チャンネルは MESSAGE_DUMP_CONCURRENCY 件ずつ並行して取得する。
     return: {channel_id: dumped_count}
     """
     ensure_dir(base_dir)
-    dumped: Dict[int, int] = {}
 
     id_to_textch: Dict[int, discord.TextChannel] = {c.id: c for c in guild.text_channels}
+    me = guild.me
+    targets: List[discord.TextChannel] = []
 
     for cid in channel_ids:
         ch = id_to_textch.get(cid)
         if not ch:
             log.warning(f"channel id {cid} not found or not a TextChannel in guild {guild.id}")
             continue
-        if not ch.permissions_for(guild.me).read_messages:
+        perms = ch.permissions_for(me)
+        # 履歴の取得には閲覧権限に加えて「メッセージ履歴を読む」が必要
+        if not (perms.read_messages and perms.read_message_history):
             log.warning(f"no read permission for #{ch.name} ({cid})")
             continue
+        targets.append(ch)
 
-        path = os.path.join(base_dir, f"messages-{cid}.jsonl.gz")
-        count = 0
-        async for msg in ch.history(limit=None, after=since_utc, oldest_first=True):
-            await append_jsonl(path, _serialize_message(msg))
-            count += 1
-            if count % 1000 == 0:
-                await asyncio.sleep(0)
-        dumped[cid] = count
-        log.info(f"dumped {count} messages from #{ch.name} ({cid})")
+    sem = asyncio.Semaphore(MESSAGE_DUMP_CONCURRENCY)
 
-    return dumped
+    async def dump_one(ch: discord.TextChannel) -> int:
+        path = os.path.join(base_dir, f"messages-{ch.id}.jsonl.gz")
+        count = 0
+        async with sem:
+            # チャンネルごとに gzip を1回だけ開き、単一の deflate ストリームに書き続ける
+            with gzip.open(path, "wb", compresslevel=6) as gz:
+                # 1行ずつではなく history の1ページ分（100件）ずつまとめて圧縮器へ渡す
+                buf: List[bytes] = []
+                async for msg in ch.history(limit=None, after=since_utc, oldest_first=True):
+                    buf.append(_serialize_message_line(msg))
+                    count += 1
+                    if len(buf) >= 100:
+                        gz.write(b"".join(buf))
+                        buf.clear()
+                    if count % 1000 == 0:
+                        await asyncio.sleep(0)
+                if buf:
+                    gz.write(b"".join(buf))
+        log.info(f"dumped {count} messages from #{ch.name} ({ch.id})")
+        return count
+
+    counts = await gather_or_cancel(*(dump_one(ch) for ch in targets))
+    return {ch.id: n for ch, n in zip(targets, counts)}
 
 def snapshot_dir_for(guild_id: int) -> str:
     stamp = datetime.now(JST).strftime("%Y%m%d-%H%M%SJST")
     return os.path.join(BACKUP_DIR, str(guild_id), stamp)
 
+# 同一ギルドのスナップショットを直列化（/backup now と週次タスクの競合防止）
+_snapshot_locks: Dict[int, asyncio.Lock] = {}
+
 async def create_snapshot(guild: discord.Guild, message_channel_ids: List[int]) -> str:
+    lock = _snapshot_locks.setdefault(guild.id, asyncio.Lock())
+    async with lock:
+        return await _create_snapshot(guild, message_channel_ids)
+
+async def _create_snapshot(guild: discord.Guild, message_channel_ids: List[int]) -> str:
     snap_dir = snapshot_dir_for(guild.id)
     ensure_dir(snap_dir)
 
     # 1) 構造
-    structure = await dump_guild_structure(guild)
-    await write_json(os.path.join(snap_dir, "guild.json.gz"), structure)
+    async def structure_part():
+        structure = await dump_guild_structure(guild)
+        await write_json(os.path.join(snap_dir, "guild.json.gz"), structure)
 
     # 2) メンバー
-    members = await dump_members(guild)
-    await write_json(os.path.join(snap_dir, "members.json.gz"), members)
+    async def members_part():
+        members = await dump_members(guild)
+        await write_json(os.path.join(snap_dir, "members.json.gz"), members)
 
     # 3) メッセージ（過去7日）
     since_utc = datetime.now(timezone.utc) - timedelta(days=7)
     msg_dir = os.path.join(snap_dir, "messages")
-    dumped = await dump_messages_for_channels(guild, since_utc, message_channel_ids, msg_dir)
+
+    # 1)〜3) は互いに独立しているので並行して取得する（1つでも失敗したら残りは止める）
+    _, _, dumped = await gather_or_cancel(
+        structure_part(),
+        members_part(),
+        dump_messages_for_channels(guild, since_utc, message_channel_ids, msg_dir),
+    )
 
     # 4) マニフェスト
     manifest = {
@@ -468,6 +915,8 @@ async def create_snapshot(guild: discord.Guild, message_channel_ids: List[int])
 
     return snap_dir
 
+SNAPSHOT_HEAD_FILES = ("guild.json.gz", "members.json.gz", "manifest.json.gz")
+
 async def send_snapshot_summary(
     guild: discord.Guild,
     target: Optional[discord.abc.Messageable],   # ← 型修正済み
@@ -479,56 +928,58 @@ async def send_snapshot_summary(
     via_followup（interaction.followup）を渡すと実行者にも送信。
     target が None の場合はチャンネル送信をスキップ。
     """
-    def collect_files() -> List[str]:
-        files: List[str] = []
-        for root, _, filenames in os.walk(snap_dir):
-            for fn in filenames:
-                if fn.endswith(".gz"):
-                    files.append(os.path.join(root, fn))
-        return files
-
-    files = collect_files()
-    head = [p for p in files if p.endswith("guild.json.gz") or p.endswith("members.json.gz") or p.endswith("manifest.json.gz")]
-    msg_files = [p for p in files if "/messages/" in p.replace("\\", "/")]
+    # 構成は既知（トップレベルの既知ファイル + messages/）なので直接列挙する
+    head = [p for p in (os.path.join(snap_dir, fn) for fn in SNAPSHOT_HEAD_FILES) if os.path.isfile(p)]
+    try:
+        with os.scandir(os.path.join(snap_dir, "messages")) as it:
+            msg_files = sorted(e.path for e in it if e.name.endswith(".gz"))
+    except FileNotFoundError:
+        msg_files = []
 
     header = f"📦 週次スナップショットを作成しました\n- Guild: **{guild.name}** ({guild.id})\n- Path: `{snap_dir}`"
 
+    def read_blobs(paths: List[str]) -> List[tuple]:
+        out = []
+        for p in paths:
+            with open(p, "rb") as f:
+                out.append((f.read(), os.path.basename(p)))
+        return out
+
     async def send_fn(content: Optional[str] = None, filepaths: Optional[List[str]] = None):
-        # 実行者へのフォローアップ
-        if via_followup is not None:
-            if filepaths:
-                await via_followup.send(content or discord.utils.MISSING,
-                                        files=[discord.File(p, filename=os.path.basename(p)) for p in filepaths])
+        # 各ファイルは1回だけ読み、送信先ごとに BytesIO で discord.File を作り直す（送信後に close されるため）
+        blobs = await asyncio.to_thread(read_blobs, filepaths) if filepaths else []
+        # 実行者へのフォローアップ → チャンネルの順に送る
+        for dest in (via_followup, target):
+            if dest is None:
+                continue
+            if blobs:
+                await dest.send(content or discord.utils.MISSING,
+                                files=[discord.File(io.BytesIO(b), filename=n) for b, n in blobs])
             else:
-                await via_followup.send(content or discord.utils.MISSING)
-        # チャンネルへ
-        if target is not None:
-            if filepaths:
-                await target.send(content or discord.utils.MISSING,
-                                  files=[discord.File(p, filename=os.path.basename(p)) for p in filepaths])
-            else:
-                await target.send(content or discord.utils.MISSING)
+                await dest.send(content or discord.utils.MISSING)
 
     await send_fn(header, head[:10])
 
+    # レート制限は discord.py が X-RateLimit-* ヘッダを見て待機するので固定スリープは不要
     CHUNK = 10
     for i in range(0, len(msg_files), CHUNK):
         chunk = msg_files[i:i+CHUNK]
         await send_fn(f"messages part {i//CHUNK + 1}", chunk)
-        await asyncio.sleep(1.0)
 
 # ========= イベント =========
 @bot.event
 async def on_ready():
-    load_settings()
     # ギルド即時反映
     if GUILD_IDS:
-        for gid in GUILD_IDS:
-            try:
-                await tree.sync(guild=discord.Object(id=gid))
+        results = await asyncio.gather(
+            *(tree.sync(guild=discord.Object(id=gid)) for gid in GUILD_IDS),
+            return_exceptions=True,
+        )
+        for gid, res in zip(GUILD_IDS, results):
+            if isinstance(res, Exception):
+                log.warning("Guild %s へのsyncに失敗: %s", gid, res)
+            else:
                 log.info("Slash commands synced for guild %s", gid)
-            except Exception as e:
-                log.warning("Guild %s へのsyncに失敗: %s", gid, e)
     else:
         try:
             await tree.sync()
@@ -537,6 +988,8 @@ async def on_ready():
             log.warning("Global sync failed: %s", e)
 
     ensure_dir(BACKUP_DIR)
+    if not vc_text_writer.is_running():
+        vc_text_writer.start()
     if not weekly_backup_task.is_running():
         weekly_backup_task.start()
 
@@ -551,8 +1004,10 @@ async def on_message(message: discord.Message):
     if not in_target_categories(message.guild.id, message.channel):
         return
 
+    ts = message.created_at.astimezone()
     rec = {
-        "ts": message.created_at.astimezone().isoformat(),
+        "ts": ts.isoformat(),
+        "ts_display": ts.strftime(TS_DISPLAY_FMT),
         "author_id": str(message.author.id),
         "author_name": f"{message.author.display_name}",
         "content": message.content or "",
@@ -561,8 +1016,7 @@ async def on_message(message: discord.Message):
         "deleted": False,
         "message_id": str(message.id),
     }
-    vc_text_buffer.setdefault(message.channel.id, []).append(rec)
-    append_message_to_disk(message.channel.id, rec)
+    buffer_record(message.guild.id, message.channel.id, rec)
 
 @bot.event
 async def on_message_edit(before: discord.Message, after: discord.Message):
@@ -570,8 +1024,10 @@ async def on_message_edit(before: discord.Message, after: discord.Message):
         return
     if not in_target_categories(after.guild.id, after.channel):
         return
+    ts = after.edited_at or datetime.now().astimezone()
     rec = {
-        "ts": (after.edited_at or datetime.now().astimezone()).isoformat(),
+        "ts": ts.isoformat(),
+        "ts_display": ts.astimezone().strftime(TS_DISPLAY_FMT),
         "author_id": str(after.author.id),
         "author_name": f"{after.display_name if hasattr(after, 'display_name') else after.author.display_name}",
         "content": f"(編集後) {after.content or ''}",
@@ -580,8 +1036,7 @@ async def on_message_edit(before: discord.Message, after: discord.Message):
         "deleted": False,
         "message_id": str(after.id),
     }
-    vc_text_buffer.setdefault(after.channel.id, []).append(rec)
-    append_message_to_disk(after.channel.id, rec)
+    buffer_record(after.guild.id, after.channel.id, rec)
 
 @bot.event
 async def on_message_delete(message: discord.Message):
@@ -589,8 +1044,10 @@ async def on_message_delete(message: discord.Message):
         return
     if not in_target_categories(message.guild.id, message.channel):
         return
+    ts = datetime.now().astimezone()
     rec = {
-        "ts": datetime.now().astimezone().isoformat(),
+        "ts": ts.isoformat(),
+        "ts_display": ts.strftime(TS_DISPLAY_FMT),
         "author_id": str(message.author.id) if message.author else "unknown",
         "author_name": getattr(message.author, "display_name", "unknown"),
         "content": "(このメッセージは削除されました)",
@@ -599,8 +1056,7 @@ async def on_message_delete(message: discord.Message):
         "deleted": True,
         "message_id": str(message.id),
     }
-    vc_text_buffer.setdefault(message.channel.id, []).append(rec)
-    append_message_to_disk(message.channel.id, rec)
+    buffer_record(message.guild.id, message.channel.id, rec)
 
 @bot.event
 async def on_guild_channel_delete(channel: discord.abc.GuildChannel):
@@ -611,16 +1067,21 @@ async def on_guild_channel_delete(channel: discord.abc.GuildChannel):
     guild = channel.guild
     conf = guild_conf(guild.id)
 
-    all_records = load_channel_records(channel.id)
+    await flush_pending_lines()
     max_keep = int(conf.get("max_messages_per_channel", 5000))
-    if len(all_records) > max_keep:
-        all_records = all_records[-max_keep:]
+    all_records = load_channel_records(channel.id, max_keep)
 
     try:
         await send_chunked_logs(guild, conf.get("log_channel_id"), channel, all_records)
     finally:
-        vc_text_buffer.pop(channel.id, None)
-        remove_channel_disk(channel.id)
+        async with _flush_lock:
+            vc_text_buffer.pop(channel.id, None)
+            _channel_guild.pop(channel.id, None)
+            _pending_lines.pop(channel.id, None)
+            _dedup_index.pop(channel.id, None)
+            _disk_count.pop(channel.id, None)
+            close_channel_fd(channel.id)
+            remove_channel_disk(channel.id)
 
 # ========= コマンド =========
 def has_allowed_role():
@@ -639,7 +1100,7 @@ class GuildConfGroup(app_commands.Group):
     async def set_log_channel(self, interaction: discord.Interaction, channel: discord.TextChannel):
         conf = guild_conf(interaction.guild_id)
         conf["log_channel_id"] = channel.id
-        save_settings()
+        save_settings(interaction.guild_id)
         await interaction.response.send_message(f"✅ ログ送信先を {channel.mention} に設定しました。", ephemeral=True)
 
     @has_allowed_role()
@@ -647,7 +1108,12 @@ class GuildConfGroup(app_commands.Group):
     async def set_max(self, interaction: discord.Interaction, count: app_commands.Range[int, 100, 200000] = 5000):
         conf = guild_conf(interaction.guild_id)
         conf["max_messages_per_channel"] = int(count)
-        save_settings()
+        # 既存チャンネルの deque も新しい上限で作り直す（古い maxlen のまま捨てられないように）
+        for cid, gid in _channel_guild.items():
+            buf = vc_text_buffer.get(cid)
+            if gid == interaction.guild_id and buf is not None:
+                vc_text_buffer[cid] = deque(buf, maxlen=int(count))
+        save_settings(interaction.guild_id)
         await interaction.response.send_message(f"✅ 最大保持件数を {count} に設定しました。", ephemeral=True)
 
     # ---- カテゴリー制御 ----
@@ -659,7 +1125,8 @@ class GuildConfGroup(app_commands.Group):
         if category.id not in wl:
             wl.append(category.id)
             conf["category_whitelist"] = wl
-            save_settings()
+            _wl_cache.pop(interaction.guild_id, None)
+            save_settings(interaction.guild_id)
             await interaction.response.send_message(f"✅ 追加: {category.name}（ID: {category.id}）", ephemeral=True)
         else:
             await interaction.response.send_message(f"ℹ️ すでに追加済み: {category.name}", ephemeral=True)
@@ -672,7 +1139,8 @@ class GuildConfGroup(app_commands.Group):
         if category.id in wl:
             wl.remove(category.id)
             conf["category_whitelist"] = wl
-            save_settings()
+            _wl_cache.pop(interaction.guild_id, None)
+            save_settings(interaction.guild_id)
             await interaction.response.send_message(f"🗑️ 削除: {category.name}（ID: {category.id}）", ephemeral=True)
         else:
             await interaction.response.send_message(f"ℹ️ 見つかりませんでした: {category.name}", ephemeral=True)
@@ -697,7 +1165,8 @@ class GuildConfGroup(app_commands.Group):
     async def clear_categories(self, interaction: discord.Interaction):
         conf = guild_conf(interaction.guild_id)
         conf["category_whitelist"] = []
-        save_settings()
+        _wl_cache.pop(interaction.guild_id, None)
+        save_settings(interaction.guild_id)
         await interaction.response.send_message("🧹 クリアしました。以後は**全カテゴリー**が対象になります。", ephemeral=True)
 
     @has_allowed_role()
@@ -725,14 +1194,17 @@ class GuildConfGroup(app_commands.Group):
     @has_allowed_role()
     @app_commands.command(name="purge_cache", description="一時保存とJSONを全削除（重複が溜まったとき等）")
     async def purge_cache(self, interaction: discord.Interaction):
-        vc_text_buffer.clear()
-        for fn in os.listdir(DATA_DIR):
-            if fn.endswith(".json") and fn != os.path.basename(SETTINGS_FILE):
-                try:
-                    os.remove(os.path.join(DATA_DIR, fn))
-                except Exception:
-                    pass
-        await interaction.response.send_message("🧹 一時保存とJSONをクリアしました。", ephemeral=True)
+        await interaction.response.defer(ephemeral=True, thinking=True)
+        # 書き出し中のバッチが削除後にファイルを作り直さないようロックを取る
+        async with _flush_lock:
+            vc_text_buffer.clear()
+            _channel_guild.clear()
+            _pending_lines.clear()
+            _dedup_index.clear()
+            _disk_count.clear()
+            close_all_channel_fds()
+            await purge_channel_files()
+        await interaction.followup.send("🧹 一時保存とJSONをクリアしました。", ephemeral=True)
 
 # ギルド即時登録（PRIMARY_GUILD_IDがあれば）
 tree.add_command(GuildConfGroup(), guild=discord.Object(id=PRIMARY_GUILD_ID) if PRIMARY_GUILD_ID else None)